@@ -1,44 +1,109 @@
 import streamlit as st
 import pandas as pd
-import requests
+import aiohttp
+import asyncio
 import openai
-import time
+from openai import AsyncOpenAI
 import io
+import json
+import os
+import hashlib
+import diskcache
 import re
+import ahocorasick
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-import fitz  # PyMuPDF
+from pdf_worker import PDF_MAX_PAGES, PDF_TEXT_CHARS, pdf_bytes_to_text
+import tiktoken
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential, wait_exponential_jitter
 
-openai.api_key = st.secrets["OPENAI_API_KEY"]
+OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 
 st.set_page_config(page_title="📄 2l PDF Extractor (Debug Mode)", layout="wide")
 st.title("📑 2l Filing Extractor (PDF-Only & Debug Friendly)")
 
 # ---------------- PDF Extraction ----------------
 
-def fetch_pdf_text(url):
+PDF_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Referer": "https://www.bseindia.com/",
+}
+
+@retry(
+    retry=retry_if_exception_type((aiohttp.ClientConnectionError, asyncio.TimeoutError)),
+    wait=wait_exponential(multiplier=0.3, max=5),
+    stop=stop_after_attempt(4),  # first try + 3 retries
+    reraise=True,
+)
+async def fetch_bytes(session, semaphore, url):
+    async with semaphore:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=10)) as response:
+            content_type = response.headers.get("Content-Type", "")
+            data = await response.read()
+    # Error pages often come back with a 200; PDFs carry %PDF in their first KB whatever the header says
+    if b"%PDF" not in data[:1024]:
+        raise ValueError(f"Not a PDF (Content-Type: {content_type or 'unknown'})")
+    return data
+
+PDF_CACHE_TTL = 24 * 60 * 60  # seconds
+
+pdf_cache = diskcache.Cache(".pdf_cache")
+
+def pdf_cache_key(url):
+    return (url, PDF_TEXT_CHARS, PDF_MAX_PAGES)
+
+async def fetch_pdf_text(session, semaphore, executor, url):
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-            "Referer": "https://www.bseindia.com/",
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        with open("temp.pdf", "wb") as f:
-            f.write(response.content)
-        doc = fitz.open("temp.pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+        data = await fetch_bytes(session, semaphore, url)
+        # Parsing is CPU-bound, so hand it to the process pool while other downloads continue.
+        # The worker lives in pdf_worker so child processes can import it without re-running this script.
+        # A crashed worker (BrokenProcessPool) lands in the except below and only costs this row.
+        text = await asyncio.get_running_loop().run_in_executor(executor, pdf_bytes_to_text, data)
     except Exception as e:
-        return f"Error: {e}"
+        return url, f"Error: {e}"
+    return url, text
+
+async def fetch_pdf_texts(links, progress):
+    # Streamlit reruns and repeated filings skip both the download and the parse
+    pdf_texts = {url: pdf_cache.get(pdf_cache_key(url)) for url in links}
+    pending = [url for url, text in pdf_texts.items() if text is None]
+
+    semaphore = asyncio.Semaphore(16)
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 6)) as executor:
+        # One keep-alive session for the whole run: filings mostly live on a couple of hosts
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(headers=PDF_HEADERS, connector=connector) as session:
+            tasks = [fetch_pdf_text(session, semaphore, executor, url) for url in pending]
+            for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+                url, text = await task
+                pdf_texts[url] = text
+                if not text.lower().startswith("error"):
+                    pdf_cache.set(pdf_cache_key(url), text, expire=PDF_CACHE_TTL)
+                progress.progress(done / len(tasks))
+    return pdf_texts
 
 
 # ---------------- GPT 2l Formatter ----------------
 
-def generate_2l_format(text):
-    prompt = f"""
-You are an expert equity research analyst. Given the following content from a company PDF, extract and present it in this custom format called '2l':
+MIN_TEXT_CHARS = 200  # below this there is nothing worth summarizing
+
+def is_low_content(text):
+    stripped = text.strip()
+    return len(stripped) < MIN_TEXT_CHARS or stripped.lower().startswith(("<html", "<!doctype"))
+
+MODEL = "gpt-4o"
+SHORT_TEXT_MODEL = "gpt-4o-mini"
+SHORT_TEXT_CHARS = 2000  # shorter filings go to the cheaper, faster model
+TEMPERATURE = 0.4
+GPT_CACHE_TTL = 24 * 60 * 60  # seconds
+BATCH_SIZE = 6  # PDFs per request; 6 x 800 tokens stays well inside the context window
+BATCH_TEXT_TOKENS = 800
+GPT_CONCURRENCY = 8  # batches in flight at once
+
+gpt_cache = diskcache.Cache(".gpt_cache")
+
+# Kept byte-identical across calls so the provider can reuse the cached prompt prefix
+STATIC_INSTRUCTIONS = """You are an expert equity research analyst. Given the content from a company PDF, extract and present it in this custom format called '2l':
 
 1. Key pointers and very important
 2. Summarize this (if possible, add % with this)
@@ -47,90 +112,174 @@ You are an expert equity research analyst. Given the following content from a co
 5. In one word (a proper heading with process)
 6. Is it good or bad for the company (in 2 lines)
 
-Only output the format. Do not explain.
+You will be given N documents indexed 0..N-1, each starting with a '---DOC i---' line. Respond with a single JSON object {"results": [...]} where element i of "results" is the '2l' output for document i: a JSON object with the keys key_pointers (1), summary (2), final_summary (3), explain5 (4), one_word (5) and good_bad (6), each a string. Do not explain."""
+
+# Output column order for the six '2l' fields
+TWO_L_KEYS = ["key_pointers", "summary", "final_summary", "explain5", "one_word", "good_bad"]
+
+# gpt-4o and gpt-4o-mini share the same tokenizer
+TOKEN_ENCODING = tiktoken.encoding_for_model(MODEL)
+
+def truncate_to_tokens(text, max_tokens=BATCH_TEXT_TOKENS):
+    tokens = TOKEN_ENCODING.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return TOKEN_ENCODING.decode(tokens[:max_tokens])
+
+def pick_model(content):
+    return SHORT_TEXT_MODEL if len(content) < SHORT_TEXT_CHARS else MODEL
+
+def gpt_cache_key(model, content):
+    return hashlib.sha256(f"{model}|{TEMPERATURE}|{STATIC_INSTRUCTIONS}|{content}".encode()).hexdigest()
+
+def format_2l_value(value):
+    # Key pointers sometimes come back as a JSON list rather than one string
+    if isinstance(value, list):
+        return "\n".join(str(item) for item in value)
+    return str(value)
+
+def parse_2l_reply(content, expected):
+    try:
+        results = json.loads(content)["results"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Reply has no 'results' list: {e!r}")
+    if not isinstance(results, list) or len(results) != expected:
+        raise ValueError(f"Expected {expected} results, got {results!r:.200}")
+    if not all(isinstance(result, dict) for result in results):
+        raise ValueError("Every result must be a JSON object")
+    return [[format_2l_value(result.get(key, "")) for key in TWO_L_KEYS] for result in results]
+
+# A malformed reply (bad JSON, missing or miscounted results) is usually a one-off, so ask once more
+@retry(retry=retry_if_exception_type(ValueError), stop=stop_after_attempt(2), reraise=True)
+# Back off only when the API pushes back, with jitter so concurrent batches don't retry in lockstep
+@retry(
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError)),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def request_2l_batch(client, model, contents):
+    documents = "\n\n".join(f"---DOC {i}---\n{content}" for i, content in enumerate(contents))
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": STATIC_INSTRUCTIONS},
+            {"role": "user", "content": documents},
+        ],
+        temperature=TEMPERATURE,
+        response_format={"type": "json_object"},
+    )
+    return parse_2l_reply(response.choices[0].message.content, len(contents))
 
-Here is the content:
-{text[:4000]}
-"""
+async def summarize_batch(client, semaphore, model, batch, contents):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-        )
-        return response['choices'][0]['message']['content']
+        async with semaphore:
+            results = await request_2l_batch(client, model, [contents[i] for i in batch])
+    except ValueError as e:
+        if len(batch) == 1:
+            return batch, [[f"Error: {e}"] + ["Error"] * 5]
+        # Don't let one bad multi-document reply wipe out the batch: ask for each document on its own
+        singles = await asyncio.gather(*[summarize_batch(client, semaphore, model, [i], contents) for i in batch])
+        return batch, [results[0] for _, results in singles]
     except Exception as e:
-        return f"Error: {e}"
-
-def parse_2l(text):
-    lines = text.split("\n")
-    values = [""] * 6
-    for line in lines:
-        line = line.strip()
-        if line.startswith("1."): values[0] = line.partition(".")[2].strip()
-        elif line.startswith("2."): values[1] = line.partition(".")[2].strip()
-        elif line.startswith("3."): values[2] = line.partition(".")[2].strip()
-        elif line.startswith("4."): values[3] = line.partition(".")[2].strip()
-        elif line.startswith("5."): values[4] = line.partition(".")[2].strip()
-        elif line.startswith("6."): values[5] = line.partition(".")[2].strip()
-    return values
+        return batch, [[f"Error: {e}"] + ["Error"] * 5] * len(batch)
+    for i, fields in zip(batch, results):
+        gpt_cache.set(gpt_cache_key(model, contents[i]), fields, expire=GPT_CACHE_TTL)
+    return batch, results
+
+async def generate_2l_format(texts, progress):
+    contents = [truncate_to_tokens(text) for text in texts]
+    # Same model + prompt + params always gives a reusable answer, so only send cache misses
+    models = [pick_model(content) for content in contents]
+    summaries = [gpt_cache.get(gpt_cache_key(model, content)) for model, content in zip(models, contents)]
+    pending = [i for i, fields in enumerate(summaries) if fields is None]
+
+    semaphore = asyncio.Semaphore(GPT_CONCURRENCY)
+    # The client's connection pool belongs to this event loop, so it lives only as long as the run
+    # max_retries=0: the tenacity policy on request_2l_batch is the only retry layer
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0) as client:
+        tasks = []
+        # Each request goes to a single model, so batch short and long filings separately
+        for model in (SHORT_TEXT_MODEL, MODEL):
+            group = [i for i in pending if models[i] == model]
+            tasks += [summarize_batch(client, semaphore, model, group[start:start + BATCH_SIZE], contents)
+                      for start in range(0, len(group), BATCH_SIZE)]
+        for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+            batch, results = await task
+            for i, fields in zip(batch, results):
+                summaries[i] = fields
+            progress.progress(done / len(tasks))
+    return summaries
 
 # ---------------- Metadata Extractors (Improved) ----------------
 
-def extract_company(text):
-    match = re.search(r'(?i)([A-Z][A-Z\s&.,]{4,})\s+(LIMITED|LTD|INDUSTRIES|CORPORATION)?', text)
-    return match.group(0).strip().title() if match else "Unknown"
+COMPANY_RE = re.compile(r'([A-Z][A-Z\s&.,]{4,}\s+(?:LIMITED|LTD|INDUSTRIES|CORPORATION)?)', re.IGNORECASE)
+SYMBOL_RE = re.compile(r'BSE\s*[:\-]?\s*([A-Z0-9]{3,10})')
+DATE_RE = re.compile(r'(\d{4})[-/]?(\d{2})[-/]?(\d{2})')
+
+SECTOR_KEYWORDS = {
+    "Pharma": "Healthcare",
+    "Chemical": "Specialty Chemicals",
+    "Bank": "Financials",
+    "Power": "Energy",
+    "Steel": "Metals",
+    "Auto": "Automobile",
+    "IT": "Technology",
+    "Software": "Technology",
+    "Retail": "Consumer",
+    "FMCG": "Consumer Staples",
+}
 
-def extract_symbol(link, text):
-    match = re.search(r'BSE\s*[:\-]?\s*([A-Z0-9]{3,10})', text)
-    return match.group(1) if match else "Unknown"
+ANNOUNCEMENT_TYPES = {
+    "expansion": "Expansion",
+    "capex": "Capex",
+    "dividend": "Dividend",
+    "merger": "M&A",
+    "acquisition": "M&A",
+    "order": "Order Win",
+    "contract": "Order Win",
+    "result": "Financial Result",
+    "profit": "Financial Result",
+    "loss": "Financial Result",
+    "plant": "Infra/Capacity",
+    "bonus": "Bonus/Split",
+    "buyback": "Buyback",
+    "joint venture": "JV/Partnership",
+}
+
+def build_keyword_automaton(keywords):
+    automaton = ahocorasick.Automaton()
+    for priority, (keyword, label) in enumerate(keywords.items()):
+        automaton.add_word(keyword.lower(), (priority, label))
+    automaton.make_automaton()
+    return automaton
+
+SECTOR_AUTOMATON = build_keyword_automaton(SECTOR_KEYWORDS)
+ANNOUNCEMENT_AUTOMATON = build_keyword_automaton(ANNOUNCEMENT_TYPES)
+
+def match_keyword(automaton, text, default):
+    # One pass over the text; the earliest keyword in the dict still wins, as with the old loop
+    best = min((value for _, value in automaton.iter(text.lower())), default=None)
+    return best[1] if best else default
 
 def guess_sector(text):
-    keywords = {
-        "Pharma": "Healthcare",
-        "Chemical": "Specialty Chemicals",
-        "Bank": "Financials",
-        "Power": "Energy",
-        "Steel": "Metals",
-        "Auto": "Automobile",
-        "IT": "Technology",
-        "Software": "Technology",
-        "Retail": "Consumer",
-        "FMCG": "Consumer Staples",
-    }
-    for k, v in keywords.items():
-        if k.lower() in text.lower():
-            return v
-    return "Unknown"
+    return match_keyword(SECTOR_AUTOMATON, text, "Unknown")
 
 def detect_type(text):
-    types = {
-        "expansion": "Expansion",
-        "capex": "Capex",
-        "dividend": "Dividend",
-        "merger": "M&A",
-        "acquisition": "M&A",
-        "order": "Order Win",
-        "contract": "Order Win",
-        "result": "Financial Result",
-        "profit": "Financial Result",
-        "loss": "Financial Result",
-        "plant": "Infra/Capacity",
-        "bonus": "Bonus/Split",
-        "buyback": "Buyback",
-        "joint venture": "JV/Partnership",
-    }
-    for k, v in types.items():
-        if k in text.lower():
-            return v
-    return "General"
-
-def extract_date_from_url(url):
-    match = re.search(r'(\d{4})[-/]?(\d{2})[-/]?(\d{2})', url)
-    if match:
-        y, m, d = match.groups()
-        return f"{y}-{m}-{d}"
-    return datetime.today().strftime("%Y-%m-%d")
+    return match_keyword(ANNOUNCEMENT_AUTOMATON, text, "General")
+
+def extract_metadata(links, texts):
+    # Works column-wise over every parsed PDF instead of calling each helper once per row
+    df = pd.DataFrame({"link": links, "text": texts}, dtype=object)
+    date_parts = df["link"].str.extract(DATE_RE)
+    dates = date_parts[0] + "-" + date_parts[1] + "-" + date_parts[2]
+    return pd.DataFrame({
+        "Symbol": df["text"].str.extract(SYMBOL_RE, expand=False).fillna("Unknown"),
+        "Company": df["text"].str.extract(COMPANY_RE, expand=False).str.strip().str.title().fillna("Unknown"),
+        "Sector": df["text"].map(guess_sector),
+        "Date": dates.fillna(datetime.today().strftime("%Y-%m-%d")),
+        "Announcement Type": df["text"].map(detect_type),
+    }).set_index(df["link"])
 
 # ---------------- UI ----------------
 
@@ -143,48 +292,68 @@ if uploaded_file:
         st.error("CSV must contain a 'link' column.")
     else:
         if st.button("🚀 Run Extraction (Debug Mode)"):
-            output = []
             progress = st.progress(0)
             status = st.empty()
+            links = df_links['link'].tolist()
+
+            # Download all PDFs concurrently, parsing each one as soon as it lands
+            status.text(f"Fetching {len(links)} PDFs...")
+            pdf_texts = asyncio.run(fetch_pdf_texts(list(dict.fromkeys(links)), progress))
 
-            for i, row in df_links.iterrows():
-                link = row['link']
-                status.text(f"Processing {i+1}/{len(df_links)}: {link}")
-                text = fetch_pdf_text(link)
+            # Summarize every PDF with real content, several per GPT request and several requests at once
+            valid_links = [link for link, text in pdf_texts.items()
+                           if text and not text.lower().startswith("error")]
+            gpt_links = [link for link in valid_links if not is_low_content(pdf_texts[link])]
+            status.text(f"Summarizing {len(gpt_links)} PDFs...")
+            progress.progress(0)
+            # Metadata extraction runs in a worker thread while the GPT requests are in flight
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                metadata_future = executor.submit(extract_metadata, valid_links,
+                                                  [pdf_texts[link] for link in valid_links])
+                summaries = asyncio.run(generate_2l_format([pdf_texts[link] for link in gpt_links], progress))
+                metadata = metadata_future.result()
+            gpt_fields = dict(zip(gpt_links, summaries))
+
+            columns = ["Link", "Symbol", "Company", "Sector", "Date", "Announcement Type",
+                       "Key Pointers", "Summary", "Final Summary",
+                       "Explain Like 5", "One Word", "Good/Bad"]
+            # Fill preallocated columns by row index and hand them to pandas as-is
+            results = {column: [None] * len(links) for column in columns}
+
+            for i, link in enumerate(links):
+                status.text(f"Processing {i+1}/{len(links)}: {link}")
+                text = pdf_texts[link]
 
                 # Debug display: show raw PDF text
                 with st.expander(f"🧾 Raw PDF Text for {link}"):
                     st.code(text[:2000] if text else "❌ No text extracted", language="text")
 
                 if not text or text.lower().startswith("error"):
-                    output.append([link, "Unknown", "Unknown", "Unknown", "Error", "Error"] + ["Error"]*6)
-                    continue
+                    values = ["Unknown", "Unknown", "Unknown", "Error", "Error"] + ["Error"]*6
+                else:
+                    meta = metadata.loc[link]
+                    values = [meta["Symbol"], meta["Company"], meta["Sector"], meta["Date"],
+                              meta["Announcement Type"]] + gpt_fields.get(link, ["Low-content PDF"]*6)
+                    progress.progress((i+1)/len(links))
 
-                date = extract_date_from_url(link)
-                company = extract_company(text)
-                sector = guess_sector(text)
-                symbol = extract_symbol(link, text)
-                ann_type = detect_type(text)
+                results["Link"][i] = link
+                for column, value in zip(columns[1:], values):
+                    results[column][i] = value
 
-                gpt_response = generate_2l_format(text)
-                fields = parse_2l(gpt_response)
-
-                output.append([link, symbol, company, sector, date, ann_type] + fields)
-                progress.progress((i+1)/len(df_links))
-                time.sleep(1.2)
-
-            columns = ["Link", "Symbol", "Company", "Sector", "Date", "Announcement Type",
-                       "Key Pointers", "Summary", "Final Summary",
-                       "Explain Like 5", "One Word", "Good/Bad"]
-            df_result = pd.DataFrame(output, columns=columns)
+            df_result = pd.DataFrame(results)
 
             st.success("✅ Done!")
             st.dataframe(df_result)
 
             buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+            with pd.ExcelWriter(buffer, engine="xlsxwriter",
+                                engine_kwargs={"options": {"strings_to_urls": False}}) as writer:
                 df_result.to_excel(writer, index=False, sheet_name="2l Debug")
             st.download_button("📥 Download Excel",
                                data=buffer.getvalue(),
                                file_name="2l_debug_summary.xlsx",
                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            st.download_button("📥 Download CSV",
+                               data=df_result.to_csv(index=False).encode("utf-8"),
+                               file_name="2l_debug_summary.csv",
+                               mime="text/csv")
@@ -0,0 +1,21 @@
+import fitz  # PyMuPDF
+
+# Only the opening of a filing is summarized, so stop parsing once we have enough of it
+PDF_TEXT_CHARS = 4096
+PDF_MAX_PAGES = 5
+
+def pdf_bytes_to_text(data, max_chars=PDF_TEXT_CHARS, max_pages=PDF_MAX_PAGES):
+    try:
+        # Opened straight from the downloaded bytes; nothing touches disk
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            parts = []
+            total = 0
+            for page_number, page in enumerate(doc):
+                if total >= max_chars or (max_pages is not None and page_number >= max_pages):
+                    break
+                page_text = page.get_text()
+                parts.append(page_text)
+                total += len(page_text)
+        return "".join(parts)
+    except Exception as e:
+        return f"Error: {e}"